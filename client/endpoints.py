@@ -0,0 +1,121 @@
+import os
+import time
+from typing import List
+
+import requests
+from requests.exceptions import ConnectionError, Timeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from client.logger import logger
+
+
+CONNECTION_ERRORS = (ConnectionError, Timeout, ConnectionRefusedError, MaxRetryError, NewConnectionError)
+
+try:
+    REQUEST_TIMEOUT = float(os.environ.get("SD_API_TIMEOUT", 10))
+except ValueError:
+    REQUEST_TIMEOUT = 10.0
+try:
+    # Seconds to wait for the server to answer once an upload is sent
+    UPLOAD_TIMEOUT = (REQUEST_TIMEOUT, float(os.environ.get("SD_UPLOAD_TIMEOUT", 300)))
+except ValueError:
+    UPLOAD_TIMEOUT = (REQUEST_TIMEOUT, 300.0)
+
+LATENCY_SMOOTHING = 0.3
+# Seconds added to the score for every consecutive failure
+FAILURE_PENALTY = 5.0
+MAX_BACKOFF = 60.0
+
+
+def parse_endpoints(value: str) -> List[str]:
+    return [url.strip().rstrip("/") for url in value.split(",") if len(url.strip())]
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = None
+        self.failures = 0
+        self.registered = False
+        # Registrations the server answered but refused, backed off like failures
+        self.rejections = 0
+        self.last_attempt = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.failures == 0
+
+    @property
+    def score(self) -> float:
+        """Lower is better. Endpoints we have not heard from yet are tried before failing ones."""
+        latency = self.latency if self.latency is not None else REQUEST_TIMEOUT / 2
+        return latency + self.failures * FAILURE_PENALTY
+
+    @property
+    def due(self) -> bool:
+        """
+        Failing servers, and servers refusing to register us, are checked again
+        with exponential backoff, so they don't stall the client or flood the log.
+        """
+        if self.healthy and not self.rejections:
+            return True
+        return time.time() - self.last_attempt >= min(MAX_BACKOFF, 2 ** (self.failures + self.rejections))
+
+    def record_success(self, elapsed: float):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += (elapsed - self.latency) * LATENCY_SMOOTHING
+        if self.failures:
+            logger.info("Server {0} is reachable again.".format(self.url))
+        self.failures = 0
+
+    def record_failure(self):
+        if self.failures == 0:
+            logger.warning("Server {0} is not responding.".format(self.url))
+        self.failures += 1
+
+    def record_registration(self, accepted: bool):
+        self.registered = accepted
+        self.rejections = 0 if accepted else self.rejections + 1
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        self.last_attempt = time.time()
+        start = time.perf_counter()
+        try:
+            result = requests.request(method, self.url + path, **kwargs)
+        except CONNECTION_ERRORS:
+            self.record_failure()
+            raise
+        if result.status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success(time.perf_counter() - start)
+        return result
+
+    def __repr__(self):
+        return "<Endpoint {0} latency={1} failures={2}>".format(self.url, self.latency, self.failures)
+
+
+class EndpointPool:
+    def __init__(self, urls: List[str]):
+        self.endpoints = [Endpoint(url) for url in urls]
+
+    def get(self, url: str) -> Endpoint:
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        # Not one of ours (anymore), talk to it without tracking it
+        return Endpoint(url)
+
+    def by_score(self) -> List[Endpoint]:
+        """Registered servers that are due, best first."""
+        endpoints = [e for e in self.endpoints if e.due and e.registered]
+        return sorted(endpoints, key=lambda e: e.score)
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+    def __len__(self):
+        return len(self.endpoints)
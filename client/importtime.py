@@ -0,0 +1,82 @@
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+
+# Modules that must stay cheap to import: registration, polling, TEST_MODE
+# and prompt parsing should never pull in torch or imaginairy.
+CONTROL_PLANE_MODULES = ["run_client", "client.task", "client.parse_prompt"]
+HEAVY_MODULES = ["torch", "imaginairy"]
+DEFAULT_BUDGET = 2.0
+# run_client lives in the repository root and the logger writes to logs/ there
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Imports a module in a fresh interpreter with `-X importtime` and returns a
+    list of (module, self us, cumulative us) for everything it imported.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {0}".format(module)],
+        capture_output=True, text=True, cwd=ROOT
+    )
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().splitlines()[-1] if proc.stderr else module)
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0])
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # Header line
+        rows.append((parts[2].strip(), self_us, cumulative_us))
+    return rows
+
+
+def report(module: str, top: int = 15) -> Tuple[float, List[str]]:
+    rows = measure(module)
+    total = sum(r[1] for r in rows) / 1e6
+    heavy = sorted({r[0] for r in rows if r[0].split(".")[0] in HEAVY_MODULES})
+
+    print("Import time for \"{0}\": {1:.3f}s ({2} modules)".format(module, total, len(rows)))
+    for name, self_us, cumulative_us in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print("  {0:>9.1f}ms  {1:>9.1f}ms  {2}".format(cumulative_us / 1e3, self_us / 1e3, name))
+    if heavy:
+        print("  Heavy modules imported: {0}".format(", ".join(heavy[:10])))
+    return total, heavy
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Summarize import time of the client modules.")
+    parser.add_argument("modules", nargs="*", default=CONTROL_PLANE_MODULES)
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument(
+        "--budget", type=float, default=None,
+        help="Fail if any module takes longer than this many seconds, or imports torch/imaginairy"
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        total, heavy = report(module, top=args.top)
+        if args.budget is not None:
+            if total > args.budget:
+                print("  Over budget: {0:.3f}s > {1:.3f}s".format(total, args.budget))
+                failed = True
+            if heavy:
+                print("  Heavy dependencies must only be imported by the generation worker.")
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from PIL import Image
+
+from client.logger import logger
+from client.upload import file_hash
+
+
+MASK_CACHE_DIR = os.environ.get(
+    "SD_MASK_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sd_client", "masks")
+)
+try:
+    MASK_CACHE_MEMORY = int(os.environ.get("SD_MASK_CACHE_MEMORY", 16))
+except ValueError:
+    MASK_CACHE_MEMORY = 16
+try:
+    MASK_CACHE_DISK_MB = int(os.environ.get("SD_MASK_CACHE_DISK_MB", 256))
+except ValueError:
+    MASK_CACHE_DISK_MB = 256
+
+
+def mask_key(image_path: str, mask_prompt: str, mask_mode_replace: bool, width: int, height: int) -> str:
+    # The mask is fitted to the output size, so that is part of the key as well
+    h = hashlib.sha256(file_hash(image_path).encode())
+    h.update("|{0}|{1}|{2}x{3}".format(mask_prompt, int(mask_mode_replace), width, height).encode())
+    return h.hexdigest()
+
+
+class MaskCache:
+    """
+    Segmentation masks computed from mask_prompt, kept in memory and on disk
+    so repeated tasks on the same input image can skip clipseg.
+    """
+
+    def __init__(self, path=MASK_CACHE_DIR, memory_size=MASK_CACHE_MEMORY, disk_mb=MASK_CACHE_DISK_MB):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_bytes = disk_mb * 1024 * 1024
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def file_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".png")
+
+    def get(self, key: str) -> Union[Image.Image, None]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            path = self.file_path(key)
+            if not os.path.isfile(path):
+                return None
+            try:
+                img = Image.open(path)
+                img.load()
+            except OSError as e:
+                logger.debug(e)
+                logger.warning("Unreadable mask in cache, removing it.")
+                os.remove(path)
+                return None
+            os.utime(path)
+            self._remember(key, img)
+            return img
+
+    def put(self, key: str, img: Image.Image):
+        with self.lock:
+            self._remember(key, img)
+            if self.disk_bytes <= 0:
+                return
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                img.save(self.file_path(key))
+            except OSError as e:
+                logger.debug(e)
+                logger.warning("Unable to write mask to cache directory.")
+                return
+            self._evict_disk()
+
+    def _remember(self, key: str, img: Image.Image):
+        self.memory[key] = img
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _mtime, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+mask_cache = MaskCache()
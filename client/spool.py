@@ -0,0 +1,166 @@
+import asyncio
+import functools
+import json
+import os
+import shutil
+import time
+from typing import Callable, List
+
+from client.logger import logger
+from client.upload import file_hash
+
+
+SPOOL_DIR = os.environ.get(
+    "SD_SPOOL_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sd_client", "spool")
+)
+try:
+    SPOOL_MAX_ATTEMPTS = int(os.environ.get("SD_SPOOL_MAX_ATTEMPTS", 10))
+except ValueError:
+    SPOOL_MAX_ATTEMPTS = 10
+SPOOL_BACKOFF = 5.0
+SPOOL_MAX_BACKOFF = 600.0
+
+UPLOADED = "uploaded"
+RETRY = "retry"
+REJECTED = "rejected"
+
+
+class SpoolEntry:
+    """A finished task waiting to be uploaded, stored as a directory with its files and a meta.json."""
+
+    def __init__(self, path: str, data: dict):
+        self.path = path
+        self.task_id: int = data["task_id"]
+        self.api_url: str = data["api_url"]
+        self.nsfw: bool = data.get("nsfw", False)
+        self.to_print: bool = data.get("to_print", False)
+        self.files: List[dict] = data["files"]
+        self.attempts: int = data.get("attempts", 0)
+        self.next_attempt: float = data.get("next_attempt", 0.0)
+        self.trace: str = data.get("trace", None)
+
+    @property
+    def due(self) -> bool:
+        return time.time() >= self.next_attempt
+
+    @property
+    def hashes(self) -> str:
+        return ",".join(f["sha256"] for f in self.files)
+
+    def fields(self) -> list:
+        return [(f["field"], os.path.join(self.path, f["name"])) for f in self.files]
+
+    def to_json(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "api_url": self.api_url,
+            "nsfw": self.nsfw,
+            "to_print": self.to_print,
+            "files": self.files,
+            "attempts": self.attempts,
+            "next_attempt": self.next_attempt,
+            "trace": self.trace,
+        }
+
+    def save(self):
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Spool:
+    """
+    Disk backed queue of finished results. Uploads run in a background thread
+    and are retried with exponential backoff, so a network blip neither loses
+    a finished image nor holds up the next task.
+    """
+
+    def __init__(self, upload: Callable, give_up: Callable, path=SPOOL_DIR, max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.upload = upload
+        self.give_up = give_up
+        self.path = path
+        self.max_attempts = max_attempts
+        self.entries: List[SpoolEntry] = []
+        self.wakeup = asyncio.Event()
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        for name in sorted(os.listdir(self.path)):
+            entry_path = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(entry_path, "meta.json")) as f:
+                    self.entries.append(SpoolEntry(entry_path, json.load(f)))
+            except (OSError, ValueError, KeyError) as e:
+                logger.debug(e)
+                logger.warning("Removing broken spool entry {0}".format(name))
+                shutil.rmtree(entry_path, ignore_errors=True)
+        if self.entries:
+            logger.info("{0} unsent result(s) found in spool.".format(len(self.entries)))
+
+    async def add(self, task_id: int, api_url: str, fields: list, nsfw=False, to_print=False, trace=None) -> SpoolEntry:
+        # Copying and hashing print files takes a while, keep it off the event loop
+        entry = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.store, task_id, api_url, fields, nsfw=nsfw, to_print=to_print, trace=trace)
+        )
+        self.entries.append(entry)
+        self.wakeup.set()
+        return entry
+
+    def store(self, task_id: int, api_url: str, fields: list, nsfw=False, to_print=False, trace=None) -> SpoolEntry:
+        entry_path = os.path.join(self.path, "{0}_{1}".format(int(time.time() * 1000), task_id))
+        os.makedirs(entry_path)
+        files = []
+        for field, src in fields:
+            name = field + os.path.splitext(src)[1]
+            dst = os.path.join(entry_path, name)
+            try:
+                os.link(src, dst)  # Free when the temp dir is on the same file system
+            except OSError:
+                shutil.copyfile(src, dst)
+            files.append({"field": field, "name": name, "sha256": file_hash(dst), "size": os.path.getsize(dst)})
+        entry = SpoolEntry(entry_path, {
+            "task_id": task_id, "api_url": api_url, "nsfw": nsfw, "to_print": to_print, "files": files,
+            "trace": trace
+        })
+        entry.save()
+        return entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def flush(self):
+        """Tries every entry that is due once."""
+        loop = asyncio.get_running_loop()
+        for entry in [e for e in self.entries if e.due]:
+            try:
+                result = await loop.run_in_executor(None, self.upload, entry)
+            except Exception as e:
+                logger.error(e)
+                result = RETRY
+            if result == RETRY and entry.attempts + 1 < self.max_attempts:
+                entry.attempts += 1
+                delay = min(SPOOL_MAX_BACKOFF, SPOOL_BACKOFF * 2 ** entry.attempts)
+                entry.next_attempt = time.time() + delay
+                entry.save()
+                logger.warning("Upload of task {0} failed, retrying in {1:.0f} seconds.".format(entry.task_id, delay))
+                continue
+            if result != UPLOADED:
+                logger.error("Giving up on uploading task {0}.".format(entry.task_id))
+                await loop.run_in_executor(None, self.give_up, entry)
+            self.entries.remove(entry)
+            entry.remove()
+
+    async def drain(self):
+        while True:
+            # Cleared first, so results added during the flush are picked up right away
+            self.wakeup.clear()
+            await self.flush()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
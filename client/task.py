@@ -6,19 +6,15 @@ from tempfile import NamedTemporaryFile
 from typing import Union
 
 import requests
-from PIL import Image
+from PIL import Image, ImageOps
 from requests.exceptions import SSLError
 from client.logger import logger
-import imaginairy.api
-from imaginairy import ImaginePrompt, imagine, WeightedPrompt, samplers
-from imaginairy.samplers import plms
 
 from client.parse_prompt import parse_prompt
-
-imaginairy.api.logger = logger
-imaginairy.schema.logger = logger
-# imaginairy.progress.logger = logger
-plms.logger = logger
+from client.tiff import write_cmyk_tiff
+from client.mask_cache import mask_cache, mask_key
+from client.worker import get_worker, load_diffusion_model
+from client.trace import TaskTrace, now_us
 
 IDLE = 0
 PROCESSING = 1
@@ -58,6 +54,9 @@ SAMPLER_TYPES = [
 ]
 
 
+MAX_VARIATIONS = 16
+
+
 class IntegrityError(Exception):
     pass
 
@@ -75,14 +74,18 @@ class SDTask():
     mask_prompt: str = ""
     mask_mode_replace: bool = True
     mask_mode_image: bool = False
+    mask_cache_key: str = ""
+    cached_mask: Image.Image = None
     prompt: str = "No prompt"
     prompt_strength: float = 0.8
     steps: int = 40
     seed: int = 0
+    seeds: list = []
     status: int = IDLE
     width: int = 512
     height: int = 512
     task_id: int = -1
+    api_url: str = ""
     fix_faces: bool = False
     upscale: bool = False
     tileable: bool = False
@@ -93,6 +96,11 @@ class SDTask():
     gpu: int = 0
     progress: float = 0.0
     sampler: str = SamplerType.KDPMPP2M
+    image_files: list = []
+    print_files: list = []
+    init_image = None
+    trace: TaskTrace = None
+    queued_at: int = 0
 
     def __init__(
             self,
@@ -104,52 +112,68 @@ class SDTask():
     ):
         if isinstance(json_data, dict):
             self.from_json(json_data)
+        self.trace = TaskTrace(self.task_id)
         self.callback = callback
         self.image_file = out_file
         self.input_image_file = in_file
         self.mask_image_file = mask_file
         self.print_file = print_file
 
+        # Every extra seed gets its own output file next to the one we were given
+        self.image_files = [out_file]
+        self.print_files = [print_file]
+        for _seed in self.seeds[1:]:
+            if self.to_print:
+                self.print_files.append(NamedTemporaryFile(prefix="aigen_print_", suffix=".tiff"))
+            else:
+                self.image_files.append(NamedTemporaryFile(prefix="aigen_", suffix=".jpg"))
+
     async def download_input_image(self):
         if len(self.input_image_url):
-            try:
+            with self.trace.span("download_input") as span:
                 try:
-                    result = requests.get(self.input_image_url)
-                except SSLError:
-                    logger.debug("HTTPS error, trying HTTP")
-                    result = requests.get(self.input_image_url.replace("https", "http"))
-            except Exception as e:
-                logger.debug(e)
-                logger.error("Unable to download input image.")
-                return
-            else:
-                if result.status_code == 200:
-                    self.input_image_file.write(result.content)
-                    logger.info("Saved input image as a temporary file.")
-                    self.input_image_downloaded = True
+                    try:
+                        result = requests.get(self.input_image_url)
+                    except SSLError:
+                        logger.debug("HTTPS error, trying HTTP")
+                        result = requests.get(self.input_image_url.replace("https", "http"))
+                except Exception as e:
+                    logger.debug(e)
+                    logger.error("Unable to download input image.")
+                    return
                 else:
-                    logger.debug(result)
-                    logger.error("Failure to get input image.")
+                    if result.status_code == 200:
+                        self.input_image_file.write(result.content)
+                        self.input_image_file.flush()
+                        span["bytes"] = len(result.content)
+                        logger.info("Saved input image as a temporary file.")
+                        self.input_image_downloaded = True
+                    else:
+                        logger.debug(result)
+                        logger.error("Failure to get input image.")
 
         if len(self.mask_image_url):
-            try:
+            with self.trace.span("download_mask") as span:
                 try:
-                    result = requests.get(self.mask_image_url)
-                except SSLError:
-                    logger.debug("HTTPS error, trying HTTP")
-                    result = requests.get(self.mask_image_url.replace("https", "http"))
-            except Exception as e:
-                logger.debug(e)
-                logger.error("Unable to download mask image.")
-                return
-            else:
-                if result.status_code == 200:
-                    self.mask_image_file.write(result.content)
-                    logger.info("Saved mask image as a temporary file.")
-                    self.mask_image_downloaded = True
+                    try:
+                        result = requests.get(self.mask_image_url)
+                    except SSLError:
+                        logger.debug("HTTPS error, trying HTTP")
+                        result = requests.get(self.mask_image_url.replace("https", "http"))
+                except Exception as e:
+                    logger.debug(e)
+                    logger.error("Unable to download mask image.")
+                    return
                 else:
-                    logger.debug(result)
-                    logger.error("Failure to get mask image.")
+                    if result.status_code == 200:
+                        self.mask_image_file.write(result.content)
+                        self.mask_image_file.flush()
+                        span["bytes"] = len(result.content)
+                        logger.info("Saved mask image as a temporary file.")
+                        self.mask_image_downloaded = True
+                    else:
+                        logger.debug(result)
+                        logger.error("Failure to get mask image.")
 
     def from_json(self, data: dict):
         self.status = IDLE
@@ -191,6 +215,23 @@ class SDTask():
         else:
             self.seed = random.randrange(0, 100000)
 
+        self.seeds = [self.seed]
+        if "seeds" in data:
+            try:
+                assert isinstance(data["seeds"], list)
+                seeds = [int(seed) for seed in data["seeds"]][:MAX_VARIATIONS]
+                assert len(seeds) > 0
+                self.seeds = seeds
+                self.seed = seeds[0]
+            except (ValueError, TypeError, AssertionError):
+                logger.warning("Invalid list of seeds, only using {0}".format(self.seed))
+        elif "count" in data:
+            try:
+                count = min(MAX_VARIATIONS, max(1, int(data["count"])))
+            except (ValueError, TypeError):
+                count = 1
+            self.seeds = [self.seed + i for i in range(count)]
+
         if "width" in data and "height" in data:
             try:
                 self.width = int(data["width"])
@@ -253,56 +294,124 @@ class SDTask():
         self.status = PROCESSING
         await self.download_input_image()
 
+        if test_run:
+            await asyncio.sleep(10)
+            img = Image.open("client/missing.jpg", "r")
+            for image_file in self.image_files:
+                img.save(image_file.name)
+            # shutil.copyfile("client/missing.jpg", self.image_file.name)
+        else:
+            self.queued_at = now_us()
+            _result = await get_worker(ModelType.NEW).run(imagine_process, self)
+
+        file_size = min(os.path.getsize(f.name) for f in self.output_files)
+
+        if file_size < 100 and not test_run: # Just in case
+            self.status = ERROR
+        else:
+            self.status = DONE
+        if self.callback:
+            self.callback(self)
+
+    @property
+    def output_files(self) -> list:
+        return self.print_files if self.to_print else self.image_files
+
+    def close_files(self):
+        for f in [self.input_image_file, self.mask_image_file] + self.image_files + self.print_files:
+            if f is not None:
+                f.close()
+
+    def imagine_prompt(self, seed: int = None, conditioning=None):
+        # Only called from the generation worker, which has imaginairy loaded
+        from imaginairy import ImaginePrompt, WeightedPrompt, LazyLoadingImage
+
+        if self.input_image_downloaded and self.init_image is None:
+            # Shared between all the variations, so it is only read once
+            self.init_image = LazyLoadingImage(filepath=self.input_image_file.name)
+
         parsed_prompt = parse_prompt(self.prompt)
         if isinstance(parsed_prompt, list):
             prompt = [WeightedPrompt(p[0], weight=p[1]) for p in parsed_prompt]
         else:
             prompt = parsed_prompt
 
-        ip = ImaginePrompt(
+        self.lookup_mask()
+
+        return ImaginePrompt(
             prompt=prompt,
             prompt_strength=self.prompt_strength,
             steps=self.steps,
             width=self.width,
             height=self.height,
-            seed=self.seed,
+            seed=self.seed if seed is None else seed,
             fix_faces=self.fix_faces,
-            init_image=self.input_image_file.name if self.input_image_downloaded else None,
-            mask_image=self.mask_image_file.name if (self.mask_image_downloaded and self.mask_mode_image) else None,
+            init_image=self.init_image,
+            mask_image=self.mask_image_file.name if (self.mask_image_downloaded and self.mask_mode_image) else self.cached_mask,
             init_image_strength=self.input_image_strength,
             upscale=self.upscale,
             tile_mode=self.tileable,
-            mask_prompt=self.mask_prompt if len(self.mask_prompt) else None,
+            mask_prompt=self.mask_prompt if len(self.mask_prompt) and self.cached_mask is None else None,
             mask_mode="replace" if self.mask_mode_replace else "keep",
             sampler_type=self.sampler,
+            conditioning=conditioning,
             model=ModelType.NEW
         )
-        if test_run:
-            await asyncio.sleep(10)
-            img = Image.open("client/missing.jpg", "r")
-            img.save(self.image_file.name)
-            # shutil.copyfile("client/missing.jpg", self.image_file.name)
-        else:
-            loop = asyncio.get_running_loop()
-            _result = await loop.run_in_executor(None, imagine_process, ip, self)
-
-        if self.to_print:
-            file_size = os.path.getsize(self.print_file.name)
-        else:
-            file_size = os.path.getsize(self.image_file.name)
-
-        if file_size < 100 and not test_run: # Just in case
-            self.status = ERROR
-        else:
-            self.status = DONE
-        if self.callback:
-            self.callback(self)
-
-
-def imagine_process(ip: ImaginePrompt, task: SDTask):
 
+    def lookup_mask(self):
+        self.mask_cache_key = ""
+        self.cached_mask = None
+        if not len(self.mask_prompt) or not self.input_image_downloaded or self.mask_mode_image:
+            return
+        self.mask_cache_key = mask_key(
+            self.input_image_file.name, self.mask_prompt, self.mask_mode_replace, self.width, self.height
+        )
+        self.cached_mask = mask_cache.get(self.mask_cache_key)
+        if self.cached_mask is not None:
+            logger.info("Using cached mask for \"{0}\"".format(self.mask_prompt))
+
+    def store_mask(self, result):
+        if not len(self.mask_cache_key) or self.cached_mask is not None:
+            return
+        mask = result.images.get("mask_binary", None)
+        if mask is None:
+            return
+        # imaginairy inverts the mask for "replace" after segmenting, undo that
+        # so the cached mask goes through the same step when passed back in.
+        if self.mask_mode_replace:
+            mask = ImageOps.invert(mask.convert("L"))
+        mask_cache.put(self.mask_cache_key, mask)
+
+
+def imagine_process(task: SDTask):
+    from imaginairy import imagine
+
+    task.trace.add_span("queued", task.queued_at, now_us())
     try:
-        for result in imagine([ip]):
+        ip = task.imagine_prompt()
+        with task.trace.span("prepare_models", gpu=True):
+            get_worker(ModelType.NEW).prepare(
+                upscale=task.upscale,
+                fix_faces=task.fix_faces,
+                mask_prompt=ip.mask_prompt is not None
+            )
+        prompts = [ip]
+        if len(task.seeds) > 1:
+            ip.conditioning = prompt_conditioning(ip)
+            # Built lazily, so later seeds can pick up the mask cached by the first
+            prompts = (
+                task.imagine_prompt(seed=seed, conditioning=ip.conditioning) if i else ip
+                for i, seed in enumerate(task.seeds)
+            )
+        task.nsfw = False
+        results = imagine(prompts)
+        seeds = task.seeds or [task.seed]
+        for i, seed in enumerate(seeds):
+            # Lets the progress filter scale progress over all the seeds
+            logger.progress("SEED:{0}/{1}".format(i, len(seeds)))
+            # Sampler steps and post-processing stages show up as instant events inside this span
+            with task.trace.span("generate", gpu=True, seed=seed):
+                result = next(results, None)
             if result != None:
                 img = None
                 if "upscaled" in result.images:
@@ -317,13 +426,16 @@ def imagine_process(ip: ImaginePrompt, task: SDTask):
                     logger.info("Saving generated image...")
                     img = result.images.get("generated", None)
                     # result.save(task.image_file.name)
-                task.nsfw = result.is_nsfw
+                task.nsfw = task.nsfw or result.is_nsfw
+                task.store_mask(result)
 
                 if img:
-                    if task.to_print:
-                        img.convert("CMYK").save(task.print_file, exif=result._exif(), compression=None, quality=100)
-                    else:
-                        img.convert("RGB").save(task.image_file.name, exif=result._exif(), quality=90)
+                    with task.trace.span("encode") as span:
+                        if task.to_print:
+                            span["bytes"] = write_cmyk_tiff(img, task.print_files[i].name, exif=result._exif())
+                        else:
+                            img.convert("RGB").save(task.image_files[i].name, exif=result._exif(), quality=90)
+                            span["bytes"] = os.path.getsize(task.image_files[i].name)
                 else:
                     raise FileNotFoundError("No image in result?")
 
@@ -332,3 +444,22 @@ def imagine_process(ip: ImaginePrompt, task: SDTask):
         logger.error(e)
         logger.error("AI generation failed.")
 
+
+def prompt_conditioning(ip):
+    """
+    Encodes the prompt text once, so variations of the same prompt can pass it
+    as `conditioning` instead of each running the text encoder again.
+    """
+    import torch
+    from imaginairy.utils import platform_appropriate_autocast
+
+    model = load_diffusion_model(
+        ip.model, config_path=ip.model_config_path,
+        for_inpainting=bool(ip.mask_image or ip.mask_prompt or ip.outpaint)
+    )
+    total_weight = sum(wp.weight for wp in ip.prompts)
+    with torch.no_grad(), platform_appropriate_autocast("autocast"):
+        return sum(
+            model.get_learned_conditioning(wp.text) * (wp.weight / total_weight)
+            for wp in ip.prompts
+        )
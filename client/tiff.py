@@ -0,0 +1,125 @@
+import os
+import struct
+import zlib
+from typing import Mapping, Union
+
+from PIL import Image
+
+
+COMPRESSION_NONE = "none"
+COMPRESSION_DEFLATE = "deflate"
+
+COMPRESSION_TAGS = {
+    COMPRESSION_NONE: 1,
+    COMPRESSION_DEFLATE: 8,
+}
+
+PRINT_COMPRESSION = os.environ.get("SD_PRINT_COMPRESSION", COMPRESSION_DEFLATE).lower()
+if PRINT_COMPRESSION not in COMPRESSION_TAGS:
+    PRINT_COMPRESSION = COMPRESSION_DEFLATE
+try:
+    STRIP_BYTES = int(os.environ.get("SD_PRINT_STRIP_BYTES", 1024 * 1024))
+except ValueError:
+    STRIP_BYTES = 1024 * 1024
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+UNDEFINED = 7
+
+EXIF_IFD = 34665
+USER_COMMENT = 37510
+
+
+def write_cmyk_tiff(
+        img: Image.Image,
+        path: str,
+        compression: str = PRINT_COMPRESSION,
+        strip_bytes: int = STRIP_BYTES,
+        exif: Union[Mapping, None] = None
+) -> int:
+    """
+    Writes the image as a strip based CMYK TIFF. Only one strip is converted
+    and held in memory at a time, instead of a full CMYK copy of the image.
+    String tags from `exif` go in the main IFD, UserComment in an EXIF IFD.
+    Returns the size of the written file.
+    """
+    width, height = img.size
+    rows_per_strip = max(1, min(height, strip_bytes // (width * 4)))
+    compress = compression == COMPRESSION_DEFLATE
+
+    strip_offsets = []
+    strip_byte_counts = []
+
+    with open(path, "wb") as f:
+        # Header, the IFD offset is patched in once the strips are written
+        f.write(b"II*\x00" + struct.pack("<I", 0))
+
+        for y in range(0, height, rows_per_strip):
+            strip = img.crop((0, y, width, min(height, y + rows_per_strip))).convert("CMYK").tobytes()
+            if compress:
+                strip = zlib.compress(strip, 6)
+            strip_offsets.append(f.tell())
+            strip_byte_counts.append(len(strip))
+            f.write(strip)
+
+        tags = [
+            (256, LONG, [width]),
+            (257, LONG, [height]),
+            (258, SHORT, [8, 8, 8, 8]),
+            (259, SHORT, [COMPRESSION_TAGS[compression]]),
+            (262, SHORT, [5]),                  # Photometric: separated (CMYK)
+            (273, LONG, strip_offsets),
+            (277, SHORT, [4]),
+            (278, LONG, [rows_per_strip]),
+            (279, LONG, strip_byte_counts),
+            (284, SHORT, [1]),                  # Planar configuration: chunky
+            (332, SHORT, [1]),                  # Ink set: CMYK
+        ]
+        for tag, value in (exif or {}).items():
+            if tag < EXIF_IFD and isinstance(value, str):
+                # ASCII fields must be 7-bit, the full text is still in UserComment
+                tags.append((tag, ASCII, value.encode("ascii", errors="replace") + b"\x00"))
+        if exif and USER_COMMENT in exif:
+            exif_offset = _write_ifd(f, [(USER_COMMENT, UNDEFINED, str(exif[USER_COMMENT]).encode())])
+            tags.append((EXIF_IFD, LONG, [exif_offset]))
+        tags.sort(key=lambda t: t[0])
+
+        ifd_offset = _write_ifd(f, tags)
+        f.seek(4)
+        f.write(struct.pack("<I", ifd_offset))
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+    return size
+
+
+def _pack_values(field_type: int, values) -> bytes:
+    if field_type == SHORT:
+        return struct.pack("<{0}H".format(len(values)), *values)
+    if field_type == LONG:
+        return struct.pack("<{0}I".format(len(values)), *values)
+    return values  # ASCII and UNDEFINED are already bytes
+
+
+def _write_ifd(f, tags: list) -> int:
+    """Writes an IFD at the end of the file and returns its offset."""
+    if f.tell() % 2:
+        f.write(b"\x00")  # IFD must start on a word boundary
+    ifd_offset = f.tell()
+    data_offset = ifd_offset + 2 + len(tags) * 12 + 4
+
+    entries = b""
+    extra = b""
+    for tag, field_type, values in tags:
+        value = _pack_values(field_type, values)
+        if len(value) <= 4:
+            entries += struct.pack("<HHI", tag, field_type, len(values)) + value.ljust(4, b"\x00")
+        else:
+            entries += struct.pack("<HHII", tag, field_type, len(values), data_offset + len(extra))
+            extra += value
+            if len(extra) % 2:
+                extra += b"\x00"
+
+    f.write(struct.pack("<H", len(tags)) + entries + struct.pack("<I", 0) + extra)
+    return ifd_offset
@@ -0,0 +1,162 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union
+
+from client.logger import logger
+
+
+TRACE_EXPORT = os.environ.get("SD_TRACE_EXPORT", "False").lower() in ('true', '1', 'yes', 'y')
+TRACE_ATTACH = os.environ.get("SD_TRACE_ATTACH", "False").lower() in ('true', '1', 'yes', 'y')
+TRACE_DIR = os.environ.get("SD_TRACE_DIR", "logs")
+# Seconds between RSS samples while a span is open, shorter spikes can be missed
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def rss_mb() -> Union[float, None]:
+    # Current resident set size, ru_maxrss would only give the peak over the whole process lifetime
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler(threading.Thread):
+    """Polls the resident set size while a span is open, to find its peak."""
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        super().__init__(name="rss_sampler", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_mb = self.peak_mb = rss_mb()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+    def stop(self) -> Union[float, None]:
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.sample()
+        return self.peak_mb
+
+
+def thread_event(pid: int, tid: int, name: str) -> dict:
+    # Metadata event naming a tid in the trace viewer
+    return {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+
+
+def cuda():
+    # Only look at the GPU if the generation worker has already imported torch
+    torch = sys.modules.get("torch", None)
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+class TaskTrace:
+    """
+    Timeline of a single task, exported in the Chrome trace event format so it
+    can be opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, task_id: int):
+        self.task_id = task_id
+        self.events = []
+        self.pid = os.getpid()
+        self.threads = {}
+
+    def _event(self, name: str, ph: str, ts: int, args: dict, **extra) -> dict:
+        tid = threading.get_native_id()
+        self.threads[tid] = threading.current_thread().name
+        event = {
+            "name": name, "cat": "task", "ph": ph, "ts": ts,
+            "pid": self.pid, "tid": tid,
+            "args": args
+        } | extra
+        self.events.append(event)
+        return event
+
+    @contextmanager
+    def span(self, name: str, gpu: bool = False, **args):
+        """
+        Records a span annotated with CPU time and peak memory. Callers may add
+        to the yielded args. Only spans on the generation worker should set
+        `gpu`, since it resets the CUDA peak memory counter.
+        """
+        gpu = cuda() if gpu else None
+        if gpu:
+            gpu.reset_peak_memory_stats()
+        start = now_us()
+        cpu_start = time.thread_time()
+        rss = RssSampler()
+        args["rss_start_mb"] = rss.start_mb
+        if rss.start_mb is not None:
+            rss.start()
+        try:
+            yield args
+        finally:
+            args["cpu_ms"] = round((time.thread_time() - cpu_start) * 1000, 2)
+            args["peak_rss_mb"] = rss.stop()
+            if gpu:
+                args["gpu_peak_mb"] = round(gpu.max_memory_allocated() / (1024 * 1024), 1)
+            self._event(name, "X", start, args, dur=now_us() - start)
+
+    def add_span(self, name: str, start: int, end: int, **args):
+        self._event(name, "X", start, args, dur=end - start)
+
+    def instant(self, name: str, **args):
+        self._event(name, "i", now_us(), args, s="t")
+
+    def to_json(self) -> dict:
+        return {
+            "traceEvents": [thread_event(self.pid, tid, name) for tid, name in self.threads.items()] + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"task_id": self.task_id}
+        }
+
+    def export(self, path: str = TRACE_DIR) -> Union[str, None]:
+        file_path = os.path.join(path, "trace_{0}_{1}.json".format(self.task_id, int(time.time())))
+        try:
+            with open(file_path, "w") as f:
+                json.dump(self.to_json(), f)
+        except OSError as e:
+            logger.debug(e)
+            logger.warning("Unable to write trace for task {0}".format(self.task_id))
+            return None
+        return file_path
+
+
+def append_span(file_path: str, name: str, start: int, end: int, **args):
+    """Adds a span to an already exported trace, for work done after the task itself is gone."""
+    try:
+        with open(file_path) as f:
+            data = json.load(f)
+        pid, tid = os.getpid(), threading.get_native_id()
+        events = data["traceEvents"]
+        if not any(e["ph"] == "M" and e["pid"] == pid and e["tid"] == tid for e in events):
+            events.insert(0, thread_event(pid, tid, threading.current_thread().name))
+        events.append({
+            "name": name, "cat": "task", "ph": "X", "ts": start, "dur": end - start,
+            "pid": pid, "tid": tid, "args": args
+        })
+        # Replaced rather than rewritten in place, the spool may hold a hard link to the old file
+        with open(file_path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(file_path + ".tmp", file_path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug(e)
@@ -0,0 +1,48 @@
+import hashlib
+import mimetypes
+import os
+import uuid
+from typing import Iterator, List, Tuple
+
+try:
+    CHUNK_SIZE = int(os.environ.get("SD_UPLOAD_CHUNK_SIZE", 256 * 1024))
+except ValueError:
+    CHUNK_SIZE = 256 * 1024
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def multipart_stream(files: List[Tuple[str, str]], chunk_size: int = CHUNK_SIZE) -> Tuple[dict, Iterator[bytes]]:
+    """
+    Builds a multipart/form-data body from (field name, file path) pairs as a
+    generator, so requests sends it with chunked transfer encoding and never
+    reads a whole file into memory.
+    """
+    boundary = uuid.uuid4().hex
+    headers = {"Content-Type": "multipart/form-data; boundary={0}".format(boundary)}
+
+    def body():
+        for field, path in files:
+            filename = os.path.basename(path)
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            yield (
+                "--{0}\r\n"
+                "Content-Disposition: form-data; name=\"{1}\"; filename=\"{2}\"\r\n"
+                "Content-Type: {3}\r\n\r\n".format(boundary, field, filename, content_type)
+            ).encode()
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield b"\r\n"
+        yield "--{0}--\r\n".format(boundary).encode()
+
+    return headers, body()
@@ -0,0 +1,223 @@
+import asyncio
+import gc
+import importlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from client.logger import logger
+
+
+PRELOAD_UPSCALER = os.environ.get("SD_PRELOAD_UPSCALER", "False").lower() in ('true', '1', 'yes', 'y')
+PRELOAD_FACEFIX = os.environ.get("SD_PRELOAD_FACEFIX", "False").lower() in ('true', '1', 'yes', 'y')
+PRELOAD_CLIPSEG = os.environ.get("SD_PRELOAD_CLIPSEG", "False").lower() in ('true', '1', 'yes', 'y')
+try:
+    MODEL_CACHE_SIZE = int(os.environ.get("SD_MODEL_CACHE_SIZE", 3))
+except ValueError:
+    MODEL_CACHE_SIZE = 3
+try:
+    MODEL_CACHE_MIN_FREE_MB = int(os.environ.get("SD_MODEL_CACHE_MIN_FREE_MB", 1024))
+except ValueError:
+    MODEL_CACHE_MIN_FREE_MB = 1024
+
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+# Test mode never loads any models
+DISABLED = "disabled"
+
+
+class SecondaryModel:
+    ESRGAN      = "esrgan"
+    CODEFORMER  = "codeformer"
+    CLIPSEG     = "clipseg"
+
+
+# imaginairy memoizes these loaders with lru_cache, so calling them loads the
+# weights once and clearing their cache releases them again.
+SECONDARY_LOADERS = {
+    SecondaryModel.ESRGAN: [
+        ("imaginairy.enhancers.upscale_realesrgan", "realesrgan_upsampler")
+    ],
+    SecondaryModel.CODEFORMER: [
+        ("imaginairy.enhancers.face_restoration_codeformer", "codeformer_model"),
+        ("imaginairy.enhancers.face_restoration_codeformer", "face_restore_helper")
+    ],
+    SecondaryModel.CLIPSEG: [
+        ("imaginairy.enhancers.clip_masking", "clip_mask_model")
+    ],
+}
+
+imaginairy_loaded = False
+
+
+def load_imaginairy():
+    """
+    Imports torch and imaginairy. This takes a long time, so it is only done
+    from the generation worker and never at module import.
+    """
+    global imaginairy_loaded
+    if imaginairy_loaded:
+        return
+    import imaginairy.api
+    import imaginairy.schema
+    from imaginairy.samplers import plms
+
+    imaginairy.api.logger = logger
+    imaginairy.schema.logger = logger
+    # imaginairy.progress.logger = logger
+    plms.logger = logger
+    imaginairy_loaded = True
+
+
+def load_diffusion_model(weights_location: str, config_path: str = None, for_inpainting: bool = False):
+    """
+    Gets the diffusion model with the same arguments imagine() uses. imaginairy
+    only keeps one model loaded, so anything else would replace it with a copy
+    in a different precision that the next task then has to load again.
+    """
+    from imaginairy.model_manager import get_diffusion_model
+    from imaginairy.utils import get_device
+
+    return get_diffusion_model(
+        weights_location=weights_location,
+        config_path=config_path,
+        half_mode=get_device() == "cuda",
+        for_inpainting=for_inpainting
+    )
+
+
+def get_loaders(name: str) -> list:
+    return [getattr(importlib.import_module(m), f) for m, f in SECONDARY_LOADERS[name]]
+
+
+def free_vram_mb() -> int:
+    # Nothing can be resident if torch was never imported
+    if "torch" not in sys.modules:
+        return -1
+    import torch
+    if not torch.cuda.is_available():
+        return -1
+    try:
+        free, _total = torch.cuda.mem_get_info()
+    except RuntimeError:
+        return -1
+    # Memory PyTorch has reserved but isn't using is still available to us
+    free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    return free // (1024 * 1024)
+
+
+class ModelCache:
+    """Bounded LRU of the secondary models imaginairy keeps loaded."""
+
+    def __init__(self, max_size=MODEL_CACHE_SIZE, min_free_mb=MODEL_CACHE_MIN_FREE_MB):
+        self.max_size = max(1, max_size)
+        self.min_free_mb = min_free_mb
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def use(self, *names: str):
+        """Loads the given models, evicting only models that are not among them."""
+        with self.lock:
+            for name in names:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    continue
+                for loader in get_loaders(name):
+                    loader()
+                self.models[name] = True
+                logger.debug("Loaded secondary model \"{0}\"".format(name))
+            self.evict(keep=names)
+
+    def evict(self, keep=()):
+        while len(self.models) > self.max_size or self.under_pressure():
+            candidates = [n for n in self.models if n not in keep]
+            if not candidates:
+                break
+            self.unload(candidates[0])
+
+    def under_pressure(self) -> bool:
+        free = free_vram_mb()
+        return 0 <= free < self.min_free_mb
+
+    def unload(self, name: str):
+        for loader in get_loaders(name):
+            loader.cache_clear()
+        self.models.pop(name, None)
+        gc.collect()
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.debug("Evicted secondary model \"{0}\"".format(name))
+
+    def __contains__(self, name):
+        return name in self.models
+
+
+class GenerationWorker:
+    """
+    Single long-lived thread that owns the GPU. Models are loaded into it once
+    and stay resident, so tasks only pay for sampling.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.state = LOADING
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd_worker")
+        self.model_cache = ModelCache()
+        self.preload_future: Future = None
+
+    def start(self) -> Future:
+        if self.preload_future is None:
+            self.preload_future = self.executor.submit(self.preload)
+        return self.preload_future
+
+    def preload(self):
+        logger.info("Loading model \"{0}\" in generation worker...".format(self.model))
+        try:
+            load_imaginairy()
+            # Inpainting tasks swap in the inpainting weights, the next regular task loads these again
+            load_diffusion_model(self.model)
+            self.prepare(upscale=PRELOAD_UPSCALER, fix_faces=PRELOAD_FACEFIX, mask_prompt=PRELOAD_CLIPSEG)
+        except Exception as e:
+            logger.error(e)
+            logger.error("Preloading models failed, they will be loaded on first task instead.")
+            self.state = FAILED
+        else:
+            logger.info("Generation worker is ready.")
+            self.state = READY
+
+    def prepare(self, upscale=False, fix_faces=False, mask_prompt=False):
+        # All models a task needs are loaded together, so none of them evicts another
+        needed = []
+        if upscale:
+            needed.append(SecondaryModel.ESRGAN)
+        if fix_faces:
+            needed.append(SecondaryModel.CODEFORMER)
+        if mask_prompt:
+            needed.append(SecondaryModel.CLIPSEG)
+        if needed:
+            self.model_cache.use(*needed)
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.executor.submit(self.call, fn, *args))
+
+    @staticmethod
+    def call(fn, *args):
+        load_imaginairy()
+        return fn(*args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+worker: GenerationWorker = None
+
+
+def get_worker(model: str) -> GenerationWorker:
+    global worker
+    if worker is None:
+        worker = GenerationWorker(model)
+    return worker
@@ -3,17 +3,21 @@ import os
 import tempfile
 import asyncio
 from typing import Union
-import requests
 import socket
-from requests.exceptions import ConnectionError, ConnectTimeout, JSONDecodeError
-from urllib3.exceptions import MaxRetryError, NewConnectionError
+from requests.exceptions import ConnectionError, JSONDecodeError
 import uuid
-from client.task import SDTask, DONE, ERROR, IDLE
+from client.task import SDTask, DONE, ERROR, IDLE, ModelType
+from client.worker import get_worker, DISABLED
+from client.upload import multipart_stream
+from client.endpoints import EndpointPool, Endpoint, parse_endpoints, CONNECTION_ERRORS, UPLOAD_TIMEOUT
+from client.spool import Spool, SpoolEntry, UPLOADED, RETRY, REJECTED
+from client.trace import TaskTrace, TRACE_EXPORT, TRACE_ATTACH, append_span, now_us
 from client.logger import logger, PROGRESS_LEVEL
 import signal
 
 
-API_URL = os.environ.get("SD_API_URL", "http://127.0.0.1:5000")
+# Comma separated, work is fetched from whichever server responds best
+API_URLS = parse_endpoints(os.environ.get("SD_API_URL", "http://127.0.0.1:5000"))
 UID_MISSING = False
 CLIENT_UID = os.environ.get("SD_CLIENT_UID", uuid.uuid4().__str__())
 CLIENT_NAME = os.environ.get("SD_CLIENT_NAME", socket.gethostname())
@@ -46,6 +50,10 @@ messages = {
 }
 
 current_task_id = -1
+current_task_url = ""
+endpoints = EndpointPool(API_URLS)
+spool: Union[Spool, None] = None
+worker = get_worker(ModelType.NEW)
 
 
 class ProgressFilter(Filter):
@@ -54,6 +62,9 @@ class ProgressFilter(Filter):
     plms_progress = 0.0
     plms_steps = 40
     stage_steps = 15
+    seed_index = 0
+    seed_count = 1
+    trace: Union[TaskTrace, None] = None
     def filter(self, record):
         if record.levelno == PROGRESS_LEVEL:
             self.parse_progress(record.getMessage())
@@ -71,11 +82,25 @@ class ProgressFilter(Filter):
     @property
     def progress(self) -> float:
         if self.stage_max > 0:
-            return self.plms_progress * self.plms_weight + self.stage * self.stage_weight
-        return self.plms_progress
+            seed_progress = self.plms_progress * self.plms_weight + self.stage * self.stage_weight
+        else:
+            seed_progress = self.plms_progress
+        return (self.seed_index + seed_progress) / max(1, self.seed_count)
 
     def parse_progress(self, str):
-        if str.startswith("STAGE:"):
+        if str.startswith("SEED:"):
+            try:
+                s = str.split("SEED:")[1].split("/")
+                self.seed_index = int(s[0])
+                self.seed_count = int(s[1])
+            except (ValueError, IndexError):
+                self.seed_index = 0
+                self.seed_count = 1
+            self.plms_progress = 0.0
+            self.stage = 0
+            self.stage_max = 0
+
+        elif str.startswith("STAGE:"):
             st1 = str.split("STAGE:")
             try:
                 st2 = st1[1].split("/")
@@ -85,6 +110,8 @@ class ProgressFilter(Filter):
                 self.stage = 0
                 self.stage_max = 0
             logger.info("Stage {0} of {1}".format(self.stage, self.stage_max))
+            if self.trace:
+                self.trace.instant("stage", stage=self.stage, stages=self.stage_max)
 
         else:
             s = str.split("/")
@@ -98,6 +125,8 @@ class ProgressFilter(Filter):
                 self.plms_progress = min(1.0, max(0.0, s1 / s2))
 
                 logger.progress("PLMS step {0} of {1}".format(s1, s2))
+                if self.trace:
+                    self.trace.instant("step", step=s1, steps=s2)
 
 
 progress_filter = ProgressFilter()
@@ -114,7 +143,8 @@ def quit_handler(signum, frame):
     logger.warning(msg)
     if current_task_id >= 0:
         logger.info("Trying to report task as failed...")
-        report_failed(current_task_id)
+        report_failed(current_task_id, current_task_url)
+    worker.shutdown()
     loop.stop()
     exit(1)
 
@@ -129,23 +159,32 @@ def task_callback(t: SDTask):
 
 
 def run_client() -> bool:
+    for endpoint in endpoints:
+        register_client(endpoint)
+    if not any(endpoint.registered for endpoint in endpoints):
+        logger.critical("Unable to register on any server, aborting.")
+        return False
+    return True
+
+
+def register_client(endpoint: Endpoint) -> bool:
     try:
-        result = requests.put(
-            API_URL + "/register_client", json=CLIENT_METADATA
-        )
-    except (ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError) as e:
+        result = endpoint.request("PUT", "/register_client", json=CLIENT_METADATA)
+    except CONNECTION_ERRORS as e:
         logger.error(e)
-        logger.critical("ERROR DURING CONNECTION")
+        logger.critical("ERROR DURING CONNECTION TO {0}".format(endpoint.url))
         return False
     else:
         try:
             resp = result.json()
         except JSONDecodeError:
             logger.error("We got invalid data from server when trying to register client. Aborting")
+            endpoint.record_registration(False)
             return False
         if "status" in resp:
             if resp["status"] != ERROR:
-                logger.info("Connected and registered on server!")
+                logger.info("Connected and registered on server {0}!".format(endpoint.url))
+                endpoint.record_registration(True)
                 logger.info("Name: \"{0}\" UUID: \"{1}\"".format(CLIENT_NAME, CLIENT_UID))
                 logger.info("Client version: \"{0}\" Reported VRAM: {1}G".format(CLIENT_VERSION, VRAM))
                 if UID_MISSING:
@@ -156,139 +195,242 @@ def run_client() -> bool:
                     logger.error(resp["message"])
                 else:
                     logger.error(resp)
+                endpoint.record_registration(False)
                 return False
     logger.error(resp)
     logger.critical("Unknown error when registering on server, aborting.")
+    endpoint.record_registration(False)
     return False
 
 
+def upload_fields(task: SDTask) -> list:
+    # Variations of a task are uploaded together as "file", "file_1", "file_2"...
+    return [
+        ("file_{0}".format(i) if i else "file", f.name) for i, f in enumerate(task.output_files)
+    ]
+
+
 async def report_done(task: SDTask):
+    trace_file = None
+    if TRACE_EXPORT:
+        # Failed tasks get a trace as well, they are usually the interesting ones
+        trace_file = task.trace.export()
+    elif TRACE_ATTACH and task.status == DONE:
+        # Only kept until the spool has its own copy, which is removed once uploaded
+        trace_file = task.trace.export(tempfile.gettempdir())
     if task.status == DONE:
+        # Uploading happens from the spool, so a network blip doesn't throw the result away
+        fields = upload_fields(task)
+        if trace_file and TRACE_ATTACH:
+            fields.append(("trace", trace_file))
         try:
-            if task.to_print:
-                result = requests.post(
-                    API_URL + "/report_print_complete/{0}".format(task.task_id),
-                    files={"file": open(task.print_file.name, 'rb')}
-                )
-            else:
-                result = requests.post(
-                    API_URL + "/report_complete/{0}/{1}".format(task.task_id, 1 if task.nsfw else 0),
-                    files={"file": open(task.image_file.name, 'rb')}
-                )
+            await spool.add(
+                task.task_id, task.api_url, fields, nsfw=task.nsfw, to_print=task.to_print,
+                trace=trace_file if TRACE_EXPORT else None
+            )
+        except OSError as e:
+            logger.error(e)
+            logger.error("Unable to store task result for upload.")
+            report_failed(task.task_id, task.api_url)
+        else:
+            logger.info("Task result queued for upload.")
+        finally:
+            if trace_file and not TRACE_EXPORT:
+                try:
+                    os.remove(trace_file)
+                except OSError as e:
+                    logger.debug(e)
+    else:
+        report_failed(task.task_id, task.api_url)
 
-            if result.status_code == 200:
-                # logger.debug(result.json())
-                resp = result.json()
-                if resp["status"] == DONE:
-                    logger.info("Task has been reported as done and uploaded!")
-                else:
-                    logger.error("Error during reporting of task:")
-                    logger.error(resp["message"])
 
-            else:
-                logger.debug(result.status_code)
-                logger.debug(result.content)
-                logger.warning(result.reason)
-                logger.warning(result.text)
-                report_failed(task.task_id)
-
-        except (
-                ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError,
-                JSONDecodeError
-        ) as e:
-            logger.debug(e)
-            logger.error("Error when reporting task status, is server down?")
-            report_failed(task.task_id)
+def upload_result(entry: SpoolEntry) -> str:
+    # Always report back to the server that handed out the task
+    endpoint = endpoints.get(entry.api_url)
+    if entry.to_print:
+        path = "/report_print_complete/{0}".format(entry.task_id)
     else:
-        report_failed(task.task_id)
+        path = "/report_complete/{0}/{1}".format(entry.task_id, 1 if entry.nsfw else 0)
+    headers = {"X-Content-SHA256": entry.hashes}
+    files = {}
+    try:
+        # Servers that keep track of uploads answer with the hashes they already have
+        check = endpoint.request("HEAD", path, headers=headers)
+        if check.status_code == 200 and check.headers.get("X-Content-SHA256") == entry.hashes:
+            logger.info("Task {0} was already uploaded, skipping.".format(entry.task_id))
+            return UPLOADED
+
+        start = now_us()
+        if entry.to_print:
+            # Print files can be huge, stream them instead of building the body in memory
+            stream_headers, body = multipart_stream(entry.fields())
+            result = endpoint.request("POST", path, data=body, headers=headers | stream_headers, timeout=UPLOAD_TIMEOUT)
+        else:
+            files = {name: open(file_path, 'rb') for name, file_path in entry.fields()}
+            result = endpoint.request("POST", path, files=files, headers=headers, timeout=UPLOAD_TIMEOUT)
+        if entry.trace:
+            append_span(
+                entry.trace, "upload", start, now_us(),
+                bytes=sum(f["size"] for f in entry.files), attempt=entry.attempts + 1, status=result.status_code
+            )
+
+        if result.status_code == 200:
+            # The server has the files at this point, a garbled reply is no reason to send them again
+            try:
+                resp = result.json()
+            except JSONDecodeError:
+                logger.warning("Got invalid data from server after uploading task {0}.".format(entry.task_id))
+                return UPLOADED
+            if resp.get("status") == DONE:
+                logger.info("Task has been reported as done and uploaded!")
+            else:
+                logger.error("Error during reporting of task:")
+                logger.error(resp.get("message", resp))
+            return UPLOADED
 
+        logger.debug(result.status_code)
+        logger.debug(result.content)
+        logger.warning(result.reason)
+        logger.warning(result.text)
+        return RETRY if result.status_code >= 500 else REJECTED
 
-def report_failed(task_id):
+    except CONNECTION_ERRORS as e:
+        logger.debug(e)
+        logger.error("Error when reporting task status, is server down?")
+        return RETRY
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def give_up_result(entry: SpoolEntry):
+    report_failed(entry.task_id, entry.api_url)
+
+
+def report_failed(task_id, api_url):
     try:
-        result = requests.put(
-            API_URL + "/report_failed/{0}".format(task_id),
+        result = endpoints.get(api_url).request(
+            "PUT", "/report_failed/{0}".format(task_id),
             json=CLIENT_METADATA
         )
         logger.debug(result.json())
         logger.warning("Task has been reported as failed!")
-    except (
-    ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError, JSONDecodeError) as e:
+    except CONNECTION_ERRORS + (JSONDecodeError,) as e:
         logger.error("Error when reporting task failure, is server down?")
 
 
+def request_task() -> Union[SDTask, None]:
+    """Asks the servers for work, fastest first, and takes the first task offered."""
+    reachable = False
+    for endpoint in endpoints.by_score():
+        try:
+            result = endpoint.request(
+                "PUT", "/process_task/" + CLIENT_UID, json=CLIENT_METADATA, headers={'Cache-Control': 'no-cache'}
+            )
+        except CONNECTION_ERRORS:
+            continue
+        reachable = True
+        try:
+            data = result.json()
+        except JSONDecodeError:
+            logger.debug(result)
+            logger.debug(result.content)
+            logger.error("Empty response from server, invalid request?")
+            continue
+        if "task_id" in data:
+            logger.info("New task received from {0}, adding to queue.".format(endpoint.url))
+            task = new_task(data)
+            task.api_url = endpoint.url
+            task.trace.instant("leased", server=endpoint.url)
+            return task
+    if not reachable:
+        raise ConnectionError("No servers reachable")
+    return None
+
+
+def new_task(data: dict) -> SDTask:
+    image_file = tempfile.NamedTemporaryFile(
+        prefix="aigen_",
+        suffix=".jpg"
+    )
+    input_image_file = tempfile.NamedTemporaryFile(
+        prefix="aigen_input_",
+        suffix=".png"
+    )
+    mask_image_file = tempfile.NamedTemporaryFile(
+        prefix="aigen_mask_",
+        suffix=".png"
+    )
+    print_file = tempfile.NamedTemporaryFile(
+        prefix="aigen_print_",
+        suffix=".tiff"
+    )
+    return SDTask(
+        out_file=image_file,
+        mask_file=mask_image_file,
+        in_file=input_image_file,
+        print_file=print_file,
+        json_data=data,
+        callback=task_callback
+    )
+
+
 async def task_runner():
     current_task: Union[SDTask, None] = None
-    global current_task_id
+    global current_task_id, current_task_url
     while True:
         if current_task:
             current_task_id = current_task.task_id
+            current_task_url = current_task.api_url
             if current_task.ready and current_task.status == IDLE:
                 progress_filter.plms_progress = 0.0
                 progress_filter.stage = 0
                 progress_filter.stage_max = 0
+                progress_filter.seed_index = 0
+                progress_filter.seed_count = 1
                 progress_filter.plms_steps = current_task.steps
+                progress_filter.trace = current_task.trace
                 await current_task.process_task(gpu=0, test_run=TEST_MODE)
             elif current_task.status == DONE or current_task.status == ERROR:
                 await report_done(current_task)
-                current_task.image_file.close()
-                current_task.input_image_file.close()
-                current_task.mask_image_file.close()
-                current_task.print_file.close()
+                current_task.close_files()
                 current_task = None
         else:
             current_task_id = -1
             progress_filter.plms_progress = 0.0
             progress_filter.stage = 0
             progress_filter.stage_max = 0
+            progress_filter.seed_index = 0
+            progress_filter.seed_count = 1
             try:
-                result = requests.put(API_URL + "/process_task/" + CLIENT_UID, json=CLIENT_METADATA, headers={'Cache-Control': 'no-cache'})
-            except (ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError) as e:
-                logger.error("Error when requesting task update, is server down? Retrying in 10 seconds.")
+                current_task = request_task()
+            except ConnectionError:
+                logger.error("Error when requesting task update, are servers down? Retrying in 10 seconds.")
                 await asyncio.sleep(9)
             else:
-                try:
-                    if "task_id" in result.json():
-                        logger.info("New task received, adding to queue.")
-                        image_file = tempfile.NamedTemporaryFile(
-                            prefix="aigen_",
-                            suffix=".jpg"
-                        )
-                        input_image_file = tempfile.NamedTemporaryFile(
-                            prefix="aigen_input_",
-                            suffix=".png"
-                        )
-                        mask_image_file = tempfile.NamedTemporaryFile(
-                            prefix="aigen_mask_",
-                            suffix=".png"
-                        )
-                        print_file = tempfile.NamedTemporaryFile(
-                            prefix="aigen_print_",
-                            suffix=".tiff"
-                        )
-                        current_task = SDTask(
-                            out_file=image_file,
-                            mask_file=mask_image_file,
-                            in_file=input_image_file,
-                            print_file=print_file,
-                            json_data=result.json(),
-                            callback=task_callback
-                        )
-                        current_task_id = current_task.task_id
-                except JSONDecodeError:
-                    logger.debug(result)
-                    logger.debug(result.content)
-                    logger.error("Empty response from server, invalid request?")
+                if current_task:
+                    current_task_id = current_task.task_id
+                    current_task_url = current_task.api_url
 
         await asyncio.sleep(1.0)
 
 
 async def poller():
+    # Polling doubles as the health check, it keeps the latency scores of every server current
     while True:
-        try:
-            _result = requests.get(API_URL + "/poll", json=CLIENT_METADATA | {"progress": progress_filter.progress})
-        except (ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError) as e:
-            logger.warning("Polling failed! Is server down?")
-            await asyncio.sleep(10)
+        for endpoint in endpoints:
+            if not endpoint.due:
+                continue
+            if not endpoint.registered:
+                register_client(endpoint)
+                continue
+            try:
+                _result = endpoint.request(
+                    "GET", "/poll",
+                    json=CLIENT_METADATA | {"progress": progress_filter.progress, "worker_state": worker.state}
+                )
+            except CONNECTION_ERRORS:
+                logger.debug("Polling {0} failed! Is server down?".format(endpoint.url))
         await asyncio.sleep(1)
 
 
@@ -296,8 +438,10 @@ async def progress_reporter():
     while True:
         if current_task_id >= 0:
             try:
-                _result = requests.get(API_URL + "/progress_update/{0}".format(current_task_id), json={"progress": progress_filter.progress})
-            except (ConnectionError, ConnectTimeout, ConnectionRefusedError, MaxRetryError, NewConnectionError) as e:
+                _result = endpoints.get(current_task_url).request(
+                    "GET", "/progress_update/{0}".format(current_task_id), json={"progress": progress_filter.progress}
+                )
+            except CONNECTION_ERRORS as e:
                 logger.warning("Reporting progress failed! Is server down?")
                 await asyncio.sleep(10)
         await asyncio.sleep(1)
@@ -323,10 +467,18 @@ async def test_task():
 
 
 async def main():
+    global spool
+    if not TEST_MODE:
+        # Load the models while we register, the test task below waits on it
+        worker.start()
+    else:
+        worker.state = DISABLED
     connected = run_client()
     if not connected:
+        worker.shutdown()
         return
     stop_event = asyncio.Event()
+    spool = Spool(upload=upload_result, give_up=give_up_result)
     if not TEST_MODE:
         logger.info("Running test task...")
         await test_task()
@@ -336,6 +488,8 @@ async def main():
     asyncio.get_event_loop().create_task(progress_reporter())
     logger.info("Starting progress reporting task.")
     asyncio.get_event_loop().create_task(poller())
+    logger.info("Starting upload spool.")
+    asyncio.get_event_loop().create_task(spool.drain())
     logger.info("Waiting for suitable tasks from server...")
     await stop_event.wait()
 
@@ -0,0 +1,87 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubServer:
+    """
+    Local stand-in for the API server. Answers with canned JSON for the
+    longest matching (method, path prefix) route and records every request.
+    """
+
+    def __init__(self, routes: dict = None, delay: float = 0.0):
+        self.routes = routes or {}
+        self.delay = delay
+        self.requests = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = "http://127.0.0.1:{0}".format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                server.requests.append((self.command, self.path, dict(self.headers), body))
+                time.sleep(server.delay)
+                routes = [r for r in server.routes if r[0] == self.command and self.path.startswith(r[1])]
+                if routes:
+                    status, data, headers = (server.routes[max(routes, key=lambda r: len(r[1]))] + ({},))[:3]
+                else:
+                    status, data, headers = 404, {}, {}
+                content = data if isinstance(data, bytes) else json.dumps(data).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(content)
+
+            do_GET = do_PUT = do_POST = do_HEAD = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def paths(self, method: str) -> list:
+        return [r[1] for r in self.requests if r[0] == method]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(routes: dict = None, delay: float = 0.0) -> StubServer:
+        server = StubServer(routes, delay)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def dead_url() -> str:
+    # A port that was free a moment ago, so connections to it are refused
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return "http://127.0.0.1:{0}".format(port)
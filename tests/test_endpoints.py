@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from requests.exceptions import ConnectionError
+
+import run_client
+from client.endpoints import EndpointPool
+from client.task import ERROR
+
+
+def task_data(task_id: int) -> dict:
+    return {
+        'task_id': task_id, 'prompt': 'a lighthouse at dusk', 'prompt_strength': 7.0, 'steps': 1,
+        'seed': 123456, 'width': 64, 'height': 64, 'upscale': False, 'fix_faces': False, 'tileable': False,
+        'input_image_url': '', 'status': 1
+    }
+
+
+def use_endpoints(monkeypatch, *urls) -> EndpointPool:
+    pool = EndpointPool(list(urls))
+    for endpoint in pool:
+        endpoint.registered = True
+    monkeypatch.setattr(run_client, "endpoints", pool)
+    return pool
+
+
+def test_dead_server_is_skipped(monkeypatch, stub_server, dead_url):
+    live = stub_server({("PUT", "/process_task/"): (200, task_data(7))})
+    pool = use_endpoints(monkeypatch, dead_url, live.url)
+
+    task = run_client.request_task()
+    assert task.task_id == 7
+    assert task.api_url == live.url
+    assert pool.get(dead_url).failures == 1
+    # Backing off, the next lease doesn't wait on it again
+    assert [e.url for e in pool.by_score()] == [live.url]
+
+
+def test_no_reachable_server(monkeypatch, dead_url):
+    use_endpoints(monkeypatch, dead_url)
+    with pytest.raises(ConnectionError):
+        run_client.request_task()
+
+
+def test_work_order_follows_score(monkeypatch, stub_server):
+    slow = stub_server({("GET", "/poll"): (200, {}), ("PUT", "/process_task/"): (200, task_data(1))}, delay=0.2)
+    fast = stub_server({("GET", "/poll"): (200, {}), ("PUT", "/process_task/"): (200, task_data(2))})
+    failing = stub_server({("GET", "/poll"): (500, {}), ("PUT", "/process_task/"): (200, task_data(3))})
+    pool = use_endpoints(monkeypatch, slow.url, failing.url, fast.url)
+
+    for endpoint in pool:
+        endpoint.request("GET", "/poll")
+    # Pretend the failing server's backoff has passed, it still ranks last
+    pool.get(failing.url).last_attempt -= 2
+    assert [e.url for e in pool.by_score()] == [fast.url, slow.url, failing.url]
+
+    task = run_client.request_task()
+    assert task.task_id == 2
+    assert slow.paths("PUT") == [] and failing.paths("PUT") == []
+
+
+def test_rejected_registration_backs_off(stub_server):
+    server = stub_server({("PUT", "/register_client"): (200, {"status": ERROR, "message": "Banned"})})
+    endpoint = EndpointPool([server.url]).get(server.url)
+
+    assert not run_client.register_client(endpoint)
+    assert not endpoint.registered
+    assert not endpoint.due
+    endpoint.last_attempt -= 2
+    assert endpoint.due
+
+    assert not run_client.register_client(endpoint)
+    endpoint.last_attempt -= 2
+    assert not endpoint.due
+    endpoint.last_attempt -= 2
+    assert endpoint.due
+    assert len(server.paths("PUT")) == 2
+
+    server.routes[("PUT", "/register_client")] = (200, {"status": 1})
+    assert run_client.register_client(endpoint)
+    assert endpoint.registered and endpoint.due
+
+
+def test_failover_reports_to_leasing_server(monkeypatch, stub_server, dead_url):
+    leasing = stub_server({
+        ("PUT", "/process_task/"): (200, task_data(11)),
+        ("GET", "/progress_update/"): (200, {}),
+        ("PUT", "/report_failed/"): (200, {}),
+    })
+    other = stub_server({("PUT", "/process_task/"): (200, {})})
+    use_endpoints(monkeypatch, dead_url, other.url, leasing.url)
+    monkeypatch.setattr(run_client, "current_task_id", -1)
+    monkeypatch.setattr(run_client, "current_task_url", "")
+
+    async def lease_and_report():
+        # The task runner leases the task first, then progress goes out for it
+        runners = asyncio.gather(run_client.task_runner(), run_client.progress_reporter())
+        try:
+            await asyncio.wait_for(runners, timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(lease_and_report())
+    assert run_client.current_task_url == leasing.url
+    assert leasing.paths("GET") == ["/progress_update/11"]
+
+    run_client.report_failed(11, run_client.current_task_url)
+    assert leasing.paths("PUT")[-1] == "/report_failed/11"
+    assert "/report_failed/11" not in other.paths("PUT")
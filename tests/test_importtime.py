@@ -0,0 +1,6 @@
+from client.importtime import main, CONTROL_PLANE_MODULES, DEFAULT_BUDGET
+
+
+def test_control_plane_startup_budget():
+    # Registration, polling and TEST_MODE must not pay for torch/imaginairy
+    assert main(CONTROL_PLANE_MODULES + ["--budget", str(DEFAULT_BUDGET)]) == 0
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+
+import run_client
+from client.spool import Spool, SpoolEntry, UPLOADED, RETRY, REJECTED
+from client.upload import file_hash
+
+
+class FakeUpload:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.attempts = []
+
+    def __call__(self, entry: SpoolEntry) -> str:
+        self.attempts.append(entry.task_id)
+        return self.results.pop(0)
+
+
+def make_spool(tmp_path, upload, give_up, max_attempts=3) -> Spool:
+    return Spool(upload=upload, give_up=give_up, path=str(tmp_path / "spool"), max_attempts=max_attempts)
+
+
+def make_result(tmp_path, name="result.jpg", content=b"not really a jpeg") -> str:
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_retry_until_max_attempts(tmp_path):
+    upload = FakeUpload(RETRY, RETRY, RETRY)
+    given_up = []
+    spool = make_spool(tmp_path, upload, given_up.append)
+
+    async def run():
+        entry = await spool.add(5, "http://server", [("file", make_result(tmp_path))])
+        await spool.flush()
+        assert entry.attempts == 1 and not entry.due
+        with open(os.path.join(entry.path, "meta.json")) as f:
+            assert json.load(f)["attempts"] == 1
+
+        # Not due yet, so nothing happens
+        await spool.flush()
+        assert len(upload.attempts) == 1
+
+        for _ in range(2):
+            entry.next_attempt = 0.0
+            await spool.flush()
+
+    asyncio.run(run())
+    assert upload.attempts == [5, 5, 5]
+    assert [e.task_id for e in given_up] == [5]
+    assert len(spool) == 0
+    assert os.listdir(spool.path) == []
+
+
+def test_rejected_gives_up_right_away(tmp_path):
+    upload = FakeUpload(REJECTED)
+    given_up = []
+    spool = make_spool(tmp_path, upload, given_up.append)
+
+    async def run():
+        await spool.add(6, "http://server", [("file", make_result(tmp_path))])
+        await spool.flush()
+
+    asyncio.run(run())
+    assert upload.attempts == [6]
+    assert [e.task_id for e in given_up] == [6]
+    assert os.listdir(spool.path) == []
+
+
+def test_uploaded_entry_is_removed(tmp_path):
+    given_up = []
+    spool = make_spool(tmp_path, FakeUpload(UPLOADED), given_up.append)
+
+    async def run():
+        await spool.add(8, "http://server", [("file", make_result(tmp_path))])
+        await spool.flush()
+
+    asyncio.run(run())
+    assert given_up == []
+    assert os.listdir(spool.path) == []
+
+
+def test_entries_survive_reload(tmp_path):
+    source = make_result(tmp_path)
+    spool = make_spool(tmp_path, FakeUpload(RETRY), lambda entry: None)
+
+    async def run():
+        await spool.add(9, "http://server", [("file", source)], nsfw=True)
+        await spool.flush()
+
+    asyncio.run(run())
+    os.remove(source)  # The spool keeps its own copy
+
+    reloaded = make_spool(tmp_path, FakeUpload(), lambda entry: None)
+    assert len(reloaded) == 1
+    entry = reloaded.entries[0]
+    assert (entry.task_id, entry.api_url, entry.nsfw, entry.attempts) == (9, "http://server", True, 1)
+    assert not entry.due
+    (field, path), = entry.fields()
+    assert field == "file"
+    assert file_hash(path) == entry.hashes
+
+
+def test_broken_entry_is_removed(tmp_path):
+    broken = tmp_path / "spool" / "1_1"
+    broken.mkdir(parents=True)
+    (broken / "meta.json").write_text("{")
+
+    spool = make_spool(tmp_path, FakeUpload(), lambda entry: None)
+    assert len(spool) == 0
+    assert not broken.exists()
+
+
+def spooled_entry(tmp_path, api_url: str) -> SpoolEntry:
+    spool = make_spool(tmp_path, FakeUpload(), lambda entry: None)
+    return asyncio.run(spool.add(12, api_url, [("file", make_result(tmp_path))]))
+
+
+def test_upload_skipped_when_server_has_hashes(tmp_path, stub_server):
+    server = stub_server()
+    entry = spooled_entry(tmp_path, server.url)
+    server.routes[("HEAD", "/report_complete/12/0")] = (200, {}, {"X-Content-SHA256": entry.hashes})
+
+    assert run_client.upload_result(entry) == UPLOADED
+    assert server.paths("POST") == []
+    assert server.requests[0][2]["X-Content-SHA256"] == entry.hashes
+
+
+def test_upload_result_status(tmp_path, stub_server):
+    server = stub_server({("POST", "/report_complete/12/0"): (200, b"not json")})
+    entry = spooled_entry(tmp_path, server.url)
+
+    # The files arrived, a reply we can't read is no reason to send them again
+    assert run_client.upload_result(entry) == UPLOADED
+    assert server.paths("POST") == ["/report_complete/12/0"]
+
+    server.routes[("POST", "/report_complete/12/0")] = (503, {})
+    assert run_client.upload_result(entry) == RETRY
+    server.routes[("POST", "/report_complete/12/0")] = (400, {})
+    assert run_client.upload_result(entry) == REJECTED
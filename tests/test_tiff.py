@@ -0,0 +1,49 @@
+import pytest
+from PIL import Image, ImageChops
+
+from client.tiff import write_cmyk_tiff, COMPRESSION_DEFLATE, COMPRESSION_NONE, EXIF_IFD, USER_COMMENT
+
+
+def gradient(width=67, height=45) -> Image.Image:
+    img = Image.new("RGB", (width, height))
+    img.putdata([(x * 3 % 256, y * 5 % 256, (x * y) % 256) for y in range(height) for x in range(width)])
+    return img
+
+
+@pytest.mark.parametrize("compression", [COMPRESSION_DEFLATE, COMPRESSION_NONE])
+def test_round_trip(tmp_path, compression):
+    img = gradient()
+    path = str(tmp_path / "print.tif")
+    # Room for 4 rows per strip, so the image is written as 12 strips
+    size = write_cmyk_tiff(img, path, compression=compression, strip_bytes=img.width * 4 * 4)
+
+    with Image.open(path) as written:
+        assert written.mode == "CMYK"
+        assert written.size == img.size
+        assert len(written.tag_v2[273]) == 12
+        assert ImageChops.difference(written, img.convert("CMYK")).getbbox() is None
+    assert size == (tmp_path / "print.tif").stat().st_size
+
+
+def test_exif_tags(tmp_path):
+    path = str(tmp_path / "print.tif")
+    exif = {
+        270: "a red fox in the snow",
+        305: "imaginAIry",
+        USER_COMMENT: "{\"prompt\": \"a red fox in the snow\"}",
+    }
+    write_cmyk_tiff(gradient(), path, exif=exif)
+
+    with Image.open(path) as written:
+        assert written.tag_v2[270] == "a red fox in the snow"
+        assert written.tag_v2[305] == "imaginAIry"
+        assert written.getexif().get_ifd(EXIF_IFD)[USER_COMMENT] == exif[USER_COMMENT].encode()
+
+
+def test_non_ascii_text(tmp_path):
+    path = str(tmp_path / "print.tif")
+    write_cmyk_tiff(gradient(), path, exif={270: "smörgåsbord", USER_COMMENT: "smörgåsbord"})
+
+    with Image.open(path) as written:
+        assert written.tag_v2[270] == "sm?rg?sbord"
+        assert written.getexif().get_ifd(EXIF_IFD)[USER_COMMENT] == "smörgåsbord".encode()